@@ -0,0 +1,96 @@
+"""
+Compares per-captcha latency and redis load of the two ways to pass a captcha from the api to a worker:
+through `RedisStorage` and inline in the queue message. Queue transit itself is not measured, only the work
+done by the api and the worker around it. Task tracking is the same for both paths and is not included.
+
+    PYTHONPATH=. python benchmarks/inline_transport.py --redis-url redis://localhost:6379 --images captchas/fns
+"""
+import argparse
+import random
+import string
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, List, Optional
+from uuid import uuid4
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from capts.app.models import Message
+from capts.businesslogic.envelope import decode_image, decode_inline, encode_inline
+from capts.storage import RedisStorage
+
+
+def load_images(path: Optional[str], n: int) -> List[bytes]:
+    if path:
+        files = sorted(file for file in Path(path).iterdir() if file.is_file())
+        return [files[i % len(files)].read_bytes() for i in range(n)]
+
+    images = []
+    for _ in range(n):
+        image = Image.new("RGB", (200, 70), "white")
+        text = "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
+        ImageDraw.Draw(image).text((20, 25), text, fill="black")
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        images.append(buffer.getvalue())
+    return images
+
+
+def through_redis(storage: RedisStorage, data: bytes) -> int:
+    # api
+    message = Message(task_id=str(uuid4()), storage_namespace=storage.namespace)
+    storage[message.task_id] = np.array(Image.open(BytesIO(data)))
+    body = message.json().encode("utf-8")
+    # worker
+    message = Message.parse_raw(body)
+    storage.pop(message.task_id)
+    return len(body)
+
+
+def inline(storage: RedisStorage, data: bytes) -> int:
+    # api
+    Image.open(BytesIO(data))
+    body = encode_inline(Message(task_id=str(uuid4()), storage_namespace=storage.namespace), data)
+    # worker
+    _, image = decode_inline(body)
+    decode_image(image)
+    return len(body)
+
+
+def run(name: str, transport: Callable[[RedisStorage, bytes], int], redis_url: str, images: List[bytes]):
+    storage = RedisStorage(dsn=redis_url, namespace="benchmark")
+    redis = storage.shards.nodes[0]
+    before = redis.info("stats")
+    latencies, body_sizes = [], []
+    for data in images:
+        started = perf_counter()
+        body_sizes.append(transport(storage, data))
+        latencies.append((perf_counter() - started) * 1000)
+    after = redis.info("stats")
+
+    n = len(images)
+    # the INFO call itself is counted as a command
+    commands = after["total_commands_processed"] - before["total_commands_processed"] - 1
+    sent = after["total_net_input_bytes"] - before["total_net_input_bytes"]
+    received = after["total_net_output_bytes"] - before["total_net_output_bytes"]
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(
+        f"{name}: latency mean {np.mean(latencies):.3f} ms, p50 {p50:.3f} ms, p99 {p99:.3f} ms; "
+        f"message {np.mean(body_sizes):.0f} bytes; redis per captcha: {commands / n:.1f} commands, "
+        f"{sent / n:.0f} bytes in, {received / n:.0f} bytes out"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of redis and inline captcha transports")
+    parser.add_argument("--redis-url", default="redis://localhost:6379")
+    parser.add_argument("--images", help="directory with captcha images. Synthetic images are used if not set")
+    parser.add_argument("-n", type=int, default=1000, help="number of captchas")
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.n)
+    print(f"{len(images)} captchas, mean file size {np.mean([len(data) for data in images]):.0f} bytes")
+    run("redis", through_redis, args.redis_url, images)
+    run("inline", inline, args.redis_url, images)
@@ -0,0 +1,62 @@
+"""
+Measures how throughput of the task and image state grows with the number of redis nodes. Every worker process
+runs the redis part of the life of a captcha: the api registers the task and stores the image, the nn worker pops
+the image and publishes the result, the client reads the task.
+
+    PYTHONPATH=. python benchmarks/sharding.py --redis-urls redis://redis-1:6379,redis://redis-2:6379 --processes 16
+
+Runs with the first 1, 2, ... N of the nodes. Nodes should run on separate hosts or cores to be meaningful.
+"""
+import argparse
+from multiprocessing import Pool
+from time import perf_counter
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from capts.businesslogic.task import Result, Task, TaskTracker
+from capts.sharding import ShardedRedis
+from capts.storage import RedisStorage
+
+
+def run_worker(job: Tuple[Sequence[str], int, int]) -> float:
+    urls, n, image_size = job
+    shards = ShardedRedis.from_urls(urls)
+    tracker = TaskTracker(shards, ttl=60)
+    storage = RedisStorage(shards=shards, namespace="benchmark", ttl=60)
+    image = np.random.randint(0, 255, image_size, dtype=np.uint8)
+
+    started = perf_counter()
+    for _ in range(n):
+        task = Task(captcha_type="benchmark")
+        tracker.register_task(task)
+        storage[task.id] = image
+        storage.pop(task.id)
+        tracker.publish_result(task.id, Result(text="123456", confidence=1.0))
+        tracker.get_task(task.id)
+    return perf_counter() - started
+
+
+def run(urls: Sequence[str], processes: int, n: int, image_size: int) -> float:
+    with Pool(processes) as pool:
+        started = perf_counter()
+        pool.map(run_worker, [(urls, n, image_size)] * processes)
+        elapsed = perf_counter() - started
+    return processes * n / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of task and image state sharded over redis nodes")
+    parser.add_argument("--redis-urls", required=True, help="comma separated redis urls")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("-n", type=int, default=2000, help="captchas per process")
+    parser.add_argument("--image-size", type=int, default=200 * 70 * 3, help="bytes of the stored image")
+    args = parser.parse_args()
+
+    all_urls = args.redis_urls.split(",")
+    results: List[float] = []
+    for nodes in range(1, len(all_urls) + 1):
+        throughput = run(all_urls[:nodes], args.processes, args.n, args.image_size)
+        results.append(throughput)
+        efficiency = throughput / (results[0] * nodes)
+        print(f"{nodes} nodes: {throughput:.0f} captchas/s, scaling efficiency {efficiency:.0%}")
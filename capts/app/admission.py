@@ -0,0 +1,112 @@
+import math
+from time import monotonic, time
+from typing import Dict, NamedTuple, Optional
+
+from capts.businesslogic.queue import MessagePublisher, QueueStats
+from capts.businesslogic.stats import SolveTimeStats
+from capts.sharding import ShardedRedis
+
+# Refills the bucket according to the time passed since the last request and takes one token if there is any.
+# Returns whether the request is allowed and the amount of tokens left
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HMSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Per-client rate limiter which state is stored in redis, so it is shared between api workers"""
+
+    key_prefix = "capts|token_bucket"
+
+    def __init__(self, redis: ShardedRedis, rate: float, burst: int):
+        self._redis = redis
+        self._rate = rate
+        self._burst = burst
+        # the script object only keeps the sha, it is run on the node of the client's key
+        self._script = redis.nodes[0].register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self, client_id: str):
+        key = f"{self.key_prefix}|{client_id}"
+        allowed, tokens = self._script(
+            keys=[key], args=[self._rate, self._burst, time()], client=self._redis.for_key(key)
+        )
+        if not allowed:
+            retry_after = math.ceil((1 - float(tokens)) / self._rate)
+            raise AdmissionRejected(f"Rate limit exceeded for client {client_id}", retry_after=max(retry_after, 1))
+
+
+class QueueLoad(NamedTuple):
+    stats: QueueStats
+    mean_solve_time: float
+    updated_at: float
+
+
+class AdmissionController:
+    """Rejects new captchas when the predicted waiting time in the queue exceeds the budget.
+
+    Queue depth, consumers count and solve rate are cached for `cache_ttl` seconds to not hit RabbitMQ and redis
+    on every request. Captchas admitted since the last refresh are added to the cached queue depth.
+    """
+
+    def __init__(
+        self,
+        solve_stats: SolveTimeStats,
+        wait_budget: float,
+        cache_ttl: float = 1.0,
+        default_solve_time: float = 1.0,
+        rate_limiter: Optional[TokenBucket] = None,
+    ):
+        self._solve_stats = solve_stats
+        self._wait_budget = wait_budget
+        self._cache_ttl = cache_ttl
+        self._default_solve_time = default_solve_time
+        self._rate_limiter = rate_limiter
+        self._loads: Dict[str, QueueLoad] = {}
+        self._admitted: Dict[str, int] = {}
+
+    def _get_load(self, captcha_type: str, publisher: MessagePublisher) -> QueueLoad:
+        load = self._loads.get(captcha_type)
+        if load is None or monotonic() - load.updated_at > self._cache_ttl:
+            mean_solve_time = self._solve_stats.mean(captcha_type) or self._default_solve_time
+            load = QueueLoad(stats=publisher.get_queue_stats(), mean_solve_time=mean_solve_time, updated_at=monotonic())
+            self._loads[captcha_type] = load
+            self._admitted[captcha_type] = 0
+        return load
+
+    def predict_wait(self, captcha_type: str, publisher: MessagePublisher) -> float:
+        load = self._get_load(captcha_type, publisher)
+        depth = load.stats.message_count + self._admitted[captcha_type] + 1
+        return depth * load.mean_solve_time / max(load.stats.consumer_count, 1)
+
+    def admit(self, captcha_type: str, publisher: MessagePublisher, client_id: str):
+        """Raises AdmissionRejected if the captcha should not be put into the queue"""
+        predicted_wait = self.predict_wait(captcha_type, publisher)
+        if predicted_wait > self._wait_budget:
+            retry_after = math.ceil(predicted_wait - self._wait_budget)
+            raise AdmissionRejected(
+                f"Predicted waiting time {predicted_wait:.1f}s exceeds {self._wait_budget:.1f}s",
+                retry_after=max(retry_after, 1),
+            )
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire(client_id)
+        self._admitted[captcha_type] += 1
@@ -0,0 +1,57 @@
+"""
+Checks that the api process stays light: imports `capts.app.main` in a fresh interpreter and fails
+if any of the neural net modules got imported, or import time or max RSS exceed the limits
+
+    python -m capts.app.import_check --max-seconds 3 --max-rss-mb 150
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+FORBIDDEN_MODULES = ["torch", "torchvision", "capts.businesslogic.nets", "capts.businesslogic.processor"]
+
+MEASURE_SCRIPT = """
+import json
+import resource
+import sys
+from time import perf_counter
+
+started = perf_counter()
+import capts.app.main
+seconds = perf_counter() - started
+
+print(json.dumps({
+    "seconds": seconds,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "forbidden": [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+def measure() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT % FORBIDDEN_MODULES], check=True, stdout=subprocess.PIPE
+    ).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks import time and memory of the api process")
+    parser.add_argument("--max-seconds", type=float, default=3.0)
+    parser.add_argument("--max-rss-mb", type=float, default=150.0)
+    args = parser.parse_args()
+
+    stats = measure()
+    print(f"Import time {stats['seconds']:.2f}s, max RSS {stats['rss_mb']:.1f} MB")
+    errors = []
+    if stats["forbidden"]:
+        errors.append(f"api imports {', '.join(stats['forbidden'])}")
+    if stats["seconds"] > args.max_seconds:
+        errors.append(f"import time exceeds {args.max_seconds}s")
+    if stats["rss_mb"] > args.max_rss_mb:
+        errors.append(f"max RSS exceeds {args.max_rss_mb} MB")
+    for error in errors:
+        print(f"FAILED: {error}")
+    sys.exit(1 if errors else 0)
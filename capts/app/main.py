@@ -1,52 +1,102 @@
 from io import BytesIO
+from typing import Dict
 
 import numpy as np
-from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
 from PIL import Image
 
+from capts.app.admission import AdmissionController, AdmissionRejected, TokenBucket
 from capts.app.models import (
     ApiGetResult,
     ApiPostResult,
     Message,
     NeuralNetResult,
     NotFoundResponse,
+    TooManyRequestsResponse,
 )
 from capts.app.utils import status2message
-from capts.businesslogic.queue import Config, MessagePublisher, get_publisher_channel
+from capts.businesslogic.envelope import encode_inline
+from capts.businesslogic.queue import Config, MessagePublisher, get_publishers
 from capts.businesslogic.task import Task, TaskNotRegisteredError
-from capts.config import CaptchaType, api_logger, redis_storage, task_tracker
+from capts.config import (
+    ADMISSION_CACHE_TTL,
+    ADMISSION_DEFAULT_SOLVE_TIME,
+    ADMISSION_WAIT_BUDGET,
+    CLIENT_BURST,
+    CLIENT_ID_HEADER,
+    CLIENT_RATE_LIMIT,
+    INLINE_IMAGE_MAX_BYTES,
+    CaptchaType,
+    api_logger,
+    redis_shards,
+    redis_storage,
+    solve_stats,
+    task_tracker,
+)
 
-publisher_channel = get_publisher_channel()
-api_logger.info(f"Connected to channel {publisher_channel}")
+# filled on the app startup to not connect to the queue on import
+captcha2publisher: Dict[CaptchaType, MessagePublisher] = {}
 
-captcha2publisher = {
-    CaptchaType.fns: MessagePublisher(publisher_channel, Config.EXCHANGE, Config.FNS_QUEUE_ROUTING_KEY),
-    CaptchaType.alcolicenziat: MessagePublisher(publisher_channel, Config.EXCHANGE, Config.ALCO_QUEUE_ROUTING_KEY),
-}
+admission_controller = AdmissionController(
+    solve_stats,
+    wait_budget=ADMISSION_WAIT_BUDGET,
+    cache_ttl=ADMISSION_CACHE_TTL,
+    default_solve_time=ADMISSION_DEFAULT_SOLVE_TIME,
+    rate_limiter=TokenBucket(redis_shards, CLIENT_RATE_LIMIT, CLIENT_BURST) if CLIENT_RATE_LIMIT else None,
+)
 
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+def connect_to_queue():
+    publishers = get_publishers()
+    api_logger.info(f"Connected to {Config.QUEUE_BACKEND} queues {list(publishers)}")
+
+    captcha2publisher[CaptchaType.fns] = publishers[Config.FNS_QUEUE]
+    captcha2publisher[CaptchaType.alcolicenziat] = publishers[Config.ALCO_QUEUE]
+
+
 def load_image_into_numpy_array(data):
     return np.array(Image.open(BytesIO(data)))
 
 
-@app.post("/process_captcha/", response_model=ApiPostResult)
-async def process_image(captcha_type: CaptchaType, captcha: UploadFile = File(...)):
+@app.post("/process_captcha/", response_model=ApiPostResult, responses={429: {"model": TooManyRequestsResponse}})
+async def process_image(request: Request, captcha_type: CaptchaType, captcha: UploadFile = File(...)):
     """
     Post one captcha image. You will get an _id_. Use this id to check for result
 
+    If the queue is too long or you send captchas too often you will get code 429.
+    Retry after the number of seconds from the `Retry-After` header
+
     __fns__ captcha [example](https://disk.yandex.ru/i/fefdsNdRlD9jWQ)
 
     __alcolicenziat__ captcha [example](https://disk.yandex.ru/i/NjHmMHWj2Au85A)
     """
-    captcha = np.array(Image.open(BytesIO(await captcha.read())))
-    task = Task()
-    task_tracker.register_task(task)
-    redis_storage.set_namespace(captcha_type.name)
-    redis_storage[task.id] = captcha
-    captcha2publisher[captcha_type].publish_message(Message(task_id=task.id, storage_namespace=captcha_type.name))
+    client_id = request.client.host
+    if CLIENT_ID_HEADER:
+        client_id = request.headers.get(CLIENT_ID_HEADER, client_id)
+    try:
+        admission_controller.admit(captcha_type.name, captcha2publisher[captcha_type], client_id)
+    except AdmissionRejected as e:
+        api_logger.info(f"Rejected captcha from {client_id}: {e}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    data = await captcha.read()
+    task = Task(captcha_type=captcha_type.name)
+    message = Message(task_id=task.id, storage_namespace=captcha_type.name)
+    if INLINE_IMAGE_MAX_BYTES and len(data) <= INLINE_IMAGE_MAX_BYTES:
+        # only reads the header to check that it is an image. Decoded by the worker
+        Image.open(BytesIO(data))
+        task_tracker.register_task(task)
+        captcha2publisher[captcha_type].publish_body(encode_inline(message, data))
+    else:
+        captcha = load_image_into_numpy_array(data)
+        task_tracker.register_task(task)
+        redis_storage.set_namespace(captcha_type.name)
+        redis_storage[task.id] = captcha
+        captcha2publisher[captcha_type].publish_message(message)
     return ApiPostResult(id=task.id)
 
 
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
 
 
 class Message(BaseModel):
@@ -6,6 +6,13 @@ class Message(BaseModel):
     storage_namespace: str
 
 
+class ControlMessage(BaseModel):
+    """Message to control nn workers, e.g. to start profiling"""
+
+    command: str
+    requests: conint(gt=0) = 20
+
+
 class NeuralNetResult(BaseModel):
     text: str
     confidence: float
@@ -22,3 +29,7 @@ class ApiPostResult(BaseModel):
 
 class NotFoundResponse(BaseModel):
     detail: str
+
+
+class TooManyRequestsResponse(BaseModel):
+    detail: str
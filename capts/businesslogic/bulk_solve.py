@@ -0,0 +1,160 @@
+"""
+Offline solver for archives of captchas. Uses processors directly, without the api and the queue.
+
+Reads images from a directory or a tar archive (optionally compressed) and appends results to a JSONL file
+as `{"name": ..., "text": ..., "confidence": ...}` or `{"name": ..., "error": ...}`.
+Images which are already in the output file are skipped, so an interrupted run can be restarted with the same command
+
+    python -m capts.businesslogic.bulk_solve fns captchas.tar.gz results.jsonl --workers 8 --batch-size 16
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tarfile
+from collections import deque
+from io import BytesIO
+from pathlib import Path
+from time import monotonic
+from typing import Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from capts.businesslogic.processor import Processor
+from capts.businesslogic.start_nn import load_processor
+from capts.config import CaptchaType, nn_logger
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".bmp"}
+
+# processor of the pool worker process. Inherited from the parent when workers are forked
+_processor: Optional[Processor] = None
+# error of loading the processor in the pool worker process
+_init_error: Optional[str] = None
+
+
+def iter_images(path: str) -> Iterator[Tuple[str, bytes]]:
+    """Lazily yields names and encoded images from a directory or a tar archive"""
+    if os.path.isdir(path):
+        for file in sorted(Path(path).rglob("*")):
+            if file.suffix.lower() in IMAGE_SUFFIXES:
+                yield str(file.relative_to(path)), file.read_bytes()
+        return
+
+    # stream mode reads the archive sequentially without building its index first
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and Path(member.name).suffix.lower() in IMAGE_SUFFIXES:
+                yield member.name, archive.extractfile(member).read()
+
+
+def iter_batches(images: Iterator[Tuple[str, bytes]], done: Set[str], batch_size: int) -> Iterator[list]:
+    batch = []
+    for name, data in images:
+        if name in done:
+            continue
+        batch.append((name, data))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_done(output_path: str) -> Set[str]:
+    """Returns names from the existing output. Drops the last line if it was written partially"""
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, "rb+") as f:
+        content = f.read()
+        complete = content[: content.rfind(b"\n") + 1]
+        if len(complete) != len(content):
+            f.truncate(len(complete))
+    return {json.loads(line)["name"] for line in complete.splitlines() if line}
+
+
+def init_worker(net_type: str, fast_weights: Optional[str], fast_threshold: float, threads: int):
+    # exceptions of the initializer make the pool restart the worker forever, so they are reported by solve_batch
+    global _processor, _init_error
+    torch.set_num_threads(threads)
+    if _processor is not None:
+        return
+    try:
+        _processor = load_processor(net_type, fast_weights, fast_threshold)
+    except Exception as e:
+        _init_error = f"Could not load processor: {e!r}"
+
+
+def solve_batch(batch: List[Tuple[str, bytes]]) -> List[dict]:
+    if _processor is None:
+        raise RuntimeError(_init_error)
+    records, names, images = [], [], []
+    for name, data in batch:
+        try:
+            images.append(np.array(Image.open(BytesIO(data)).convert("RGB")))
+            names.append(name)
+        except Exception as e:
+            records.append({"name": name, "error": f"Could not decode image: {e}"})
+    if images:
+        try:
+            results = _processor.process_batch(images)
+            records.extend(
+                {"name": name, "text": result.text, "confidence": result.confidence}
+                for name, result in zip(names, results)
+            )
+        except Exception as e:
+            records.extend({"name": name, "error": f"Could not process image: {e}"} for name in names)
+    return records
+
+
+def write_records(output, records: List[dict]) -> int:
+    output.write("".join(json.dumps(record) + "\n" for record in records))
+    output.flush()
+    return len(records)
+
+
+def solve(args):
+    global _processor
+    # fails before any work is done if weights can not be loaded
+    _processor = load_processor(args.net_type, args.fast_weights, args.fast_threshold)
+
+    done = load_done(args.output)
+    if done:
+        nn_logger.info(f"Resuming: {len(done)} captchas are already solved")
+
+    batches = iter_batches(iter_images(args.input), done, args.batch_size)
+    initargs = (args.net_type, args.fast_weights, args.fast_threshold, args.threads)
+    solved, started, last_report = 0, monotonic(), monotonic()
+    output = open(args.output, "a")
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=initargs) as pool:
+        # bounded number of batches in flight, so the archive is read only as fast as it is solved
+        in_flight = deque()
+        for batch in batches:
+            in_flight.append(pool.apply_async(solve_batch, (batch,)))
+            if len(in_flight) < 2 * args.workers:
+                continue
+            solved += write_records(output, in_flight.popleft().get())
+            if monotonic() - last_report > args.report_every:
+                last_report = monotonic()
+                nn_logger.info(f"Solved {solved} captchas, {solved / (last_report - started):.1f} captchas/s")
+        while in_flight:
+            solved += write_records(output, in_flight.popleft().get())
+    output.close()
+
+    elapsed = max(monotonic() - started, 1e-9)
+    nn_logger.info(f"Finished: solved {solved} captchas in {elapsed:.1f}s, {solved / elapsed:.1f} captchas/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solves captchas from a directory or a tar archive")
+    parser.add_argument("net_type", choices=[CaptchaType.fns.name, CaptchaType.alcolicenziat.name])
+    parser.add_argument("input", help="directory or tar archive with captcha images")
+    parser.add_argument("output", help="JSONL file with results. Appended to if exists")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per worker")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--report-every", type=float, default=10.0, help="seconds between throughput reports")
+    parser.add_argument("--fast-weights", help="weights of the fast path recognizer. Fast path is disabled if not set")
+    parser.add_argument("--fast-threshold", type=float, default=0.9, help="min confidence to accept fast path result")
+    solve(parser.parse_args())
@@ -0,0 +1,61 @@
+"""
+Binary envelope to send small captchas inside the queue message instead of storing them in redis.
+
+Layout: magic (3 bytes) | version (1 byte) | task uuid (16 bytes) | namespace length (1 byte) | namespace | image.
+Image is the uploaded file as is, so it is usually several times smaller than the pickled array.
+JSON messages never start with the magic, so both kinds of messages can be sent to the same queue
+"""
+import struct
+import uuid
+from io import BytesIO
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+from capts.app.models import Message
+
+MAGIC = b"\x00CI"
+VERSION = 1
+HEADER = struct.Struct(">3sB16sB")
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def is_inline(body: bytes) -> bool:
+    return body[: len(MAGIC)] == MAGIC
+
+
+def encode_inline(message: Message, image: bytes) -> bytes:
+    namespace = message.storage_namespace.encode("utf-8")
+    header = HEADER.pack(MAGIC, VERSION, uuid.UUID(message.task_id).bytes, len(namespace))
+    return b"".join((header, namespace, image))
+
+
+def decode_inline(body: bytes) -> Tuple[Message, bytes]:
+    if len(body) < HEADER.size:
+        raise EnvelopeError(f"Envelope of {len(body)} bytes is shorter than its header")
+    magic, version, task_id, namespace_length = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise EnvelopeError(f"Unsupported envelope {magic!r} version {version}")
+    namespace_end = HEADER.size + namespace_length
+    if len(body) < namespace_end:
+        raise EnvelopeError(f"Namespace of {namespace_length} bytes runs past the end of the envelope")
+    message = Message(
+        task_id=str(uuid.UUID(bytes=task_id)), storage_namespace=body[HEADER.size : namespace_end].decode("utf-8")
+    )
+    return message, body[namespace_end:]
+
+
+def parse_message(body: bytes) -> Message:
+    """Message of an inline or JSON body"""
+    if is_inline(body):
+        message, _ = decode_inline(body)
+        return message
+    return Message.parse_raw(body)
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    return np.array(Image.open(BytesIO(data)))
@@ -1,3 +1,4 @@
+import math
 import pickle
 
 import torch
@@ -94,3 +95,77 @@ class DeclarationCaptchasNet(nn.Module):
 
     def forward(self, inputs):
         return self.model(inputs)
+
+
+class CRNN(nn.Module):
+    """
+    small convolutional recurrent net. Returns log probabilities of shape (time, batch, n_classes) for CTC
+    """
+
+    def __init__(self, n_classes, hidden_size=128):
+        super().__init__()
+
+        def block(in_channels, out_channels, pool):
+            return nn.Sequential(
+                nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, bias=False),
+                nn.BatchNorm2d(out_channels),
+                nn.ReLU(inplace=True),
+                nn.MaxPool2d(pool),
+            )
+
+        # (1, 32, 128) -> (128, 1, 32)
+        self.features = nn.Sequential(
+            block(1, 32, (2, 2)),
+            block(32, 64, (2, 2)),
+            block(64, 96, (2, 1)),
+            block(96, 128, (4, 1)),
+        )
+        self.rnn = nn.GRU(128, hidden_size, bidirectional=True)
+        self.classifier = nn.Linear(2 * hidden_size, n_classes)
+
+    def forward(self, inputs):
+        features = self.features(inputs).squeeze(2).permute(2, 0, 1)
+        outputs, _ = self.rnn(features)
+        return self.classifier(outputs).log_softmax(2)
+
+
+class CTCCaptchasNet(nn.Module):
+    """
+    class for lightweight net recognizing the whole captcha string at once. Used as a fast path before detectors
+    """
+
+    input_size = (32, 128)
+
+    def __init__(self, vocab_path, weights_path=None):
+        super().__init__()
+        vocab = pickle.load(open(vocab_path, "rb"))
+        chars = vocab.values() if isinstance(vocab, dict) else vocab
+        # index 0 is reserved for CTC blank
+        self.vocab = [""] + sorted({char for char in chars if char})
+        self.char2index = {char: index for index, char in enumerate(self.vocab)}
+        self.weights = torch.load(weights_path, map_location="cpu") if weights_path else None
+
+        self.model = CRNN(n_classes=len(self.vocab))
+        if self.weights:
+            load_weights(self.model, self.weights)
+
+    def preprocess(self, image):
+        """Converts HxWxC uint8 image to 1xHxW grayscale tensor of the net input size"""
+        image = torch.from_numpy(image[:, :, :3] / 255.0).float().mean(2)
+        image = nn.functional.interpolate(image[None, None], size=self.input_size, mode="bilinear", align_corners=False)
+        return image[0]
+
+    def encode(self, text):
+        return [self.char2index[char] for char in text]
+
+    def decode(self, log_probs):
+        """Greedy CTC decoding. Confidence is the probability of the best path"""
+        best_log_probs, best_indexes = log_probs.max(2)
+        results = []
+        for indexes, path_log_prob in zip(best_indexes.t().tolist(), best_log_probs.sum(0).tolist()):
+            chars = [index for i, index in enumerate(indexes) if index != 0 and (i == 0 or index != indexes[i - 1])]
+            results.append(("".join(self.vocab[index] for index in chars), math.exp(path_log_prob)))
+        return results
+
+    def forward(self, inputs):
+        return self.model(inputs)
@@ -1,33 +1,64 @@
 import abc
-from typing import List
+import json
+from time import monotonic, time
+from typing import List, Optional
 
 import numpy as np
 import torch
-from pika import BasicProperties
-from pika.adapters.blocking_connection import BlockingChannel
-from pika.amqp_object import Method
+from pydantic import ValidationError
+from redis.exceptions import RedisError
 from torch.nn import Module
 
-from capts.app.models import Message
-from capts.businesslogic.task import Result, TaskStatus
+from capts.app.models import ControlMessage, Message
+from capts.businesslogic.envelope import (
+    EnvelopeError,
+    decode_image,
+    decode_inline,
+    is_inline,
+    parse_message,
+)
+from capts.businesslogic.nets import CTCCaptchasNet
+from capts.businesslogic.profiling import Profiler
+from capts.businesslogic.queue import Delivery, MessageConsumer
+from capts.businesslogic.task import Result, TaskStage, TaskStatus
 from capts.businesslogic.utils import norm_image
-from capts.config import nn_logger, redis_storage, task_tracker
+from capts.config import (
+    PROFILE_DIR,
+    nn_logger,
+    redis_storage,
+    solve_stats,
+    task_tracker,
+)
 
 
 class ExpectedException(Exception):
     pass
 
 
+def is_control(body: bytes) -> bool:
+    if is_inline(body):
+        return False
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(payload, dict) and "command" in payload
+
+
 def handle_unhandled_exceptions(func):
     def wrapper(*args, **kwargs):
         try:
             result = func(*args, **kwargs)
         except Exception as e:
-            _, channel, method, _, body = args
+            _, delivery = args
             if not isinstance(e, ExpectedException):
                 nn_logger.critical("Unhandled exception occurred")
-            channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
-            message = Message.parse_raw(body)
+            delivery.reject()
+            try:
+                message = parse_message(delivery.body)
+            except (ValueError, EnvelopeError):
+                nn_logger.exception(f"Could not parse rejected message {delivery.body[:100]!r}")
+                return
             task_tracker.update_status(message.task_id, status=TaskStatus.failed)
             return
         return result
@@ -36,18 +67,66 @@ def handle_unhandled_exceptions(func):
 
 
 class Processor(abc.ABC):
-    def __init__(self, model: Module, channel: BlockingChannel, in_queue: str):
+    def __init__(
+        self,
+        model: Module,
+        consumer: Optional[MessageConsumer] = None,
+        fast_model: Optional[CTCCaptchasNet] = None,
+        fast_threshold: float = 0.9,
+    ):
+        """
+        If `fast_model` is set, it recognizes captchas first and its result is returned when the confidence is not
+        lower than `fast_threshold`. Otherwise the captcha is passed to the `model`.
+        Processor without consumer can only be used to process captchas directly
+        """
         self.model = model
-        self.channel = channel
-        self.channel.basic_consume(queue=in_queue, on_message_callback=self._handle_request)
-        self.channel.basic_qos(prefetch_count=1)
+        self.fast_model = fast_model
+        self.fast_threshold = fast_threshold
+        self.consumer = consumer
+        self.profiler = Profiler(PROFILE_DIR)
 
     def process(self, captcha: np.ndarray) -> Result:
-        inputs = self.preprocess(captcha)
-        net_output = self.predict(inputs)
-        result = self.postprocess(net_output)
+        if self.fast_model is not None:
+            result = self.process_fast(captcha)
+            if result.confidence >= self.fast_threshold:
+                return result
+        return self.process_full(captcha)
+
+    def process_full(self, captcha: np.ndarray) -> Result:
+        with self.profiler.stage("preprocess"):
+            inputs = self.preprocess(captcha)
+        with self.profiler.stage("predict"), self.profiler.trace("predict"):
+            net_output = self.predict(inputs)
+        with self.profiler.stage("postprocess"):
+            result = self.postprocess(net_output)
         return result
 
+    def process_fast(self, captcha: np.ndarray) -> Result:
+        return self.process_fast_batch([captcha])[0]
+
+    def process_batch(self, captchas: List[np.ndarray]) -> List[Result]:
+        """Same as `process` but runs nets once for all the captchas"""
+        results = [None] * len(captchas)
+        if self.fast_model is not None:
+            for i, result in enumerate(self.process_fast_batch(captchas)):
+                if result.confidence >= self.fast_threshold:
+                    results[i] = result
+        rest = [i for i, result in enumerate(results) if result is None]
+        if rest:
+            inputs = [tensor for i in rest for tensor in self.preprocess(captchas[i])]
+            for i, prediction in zip(rest, self.predict(inputs)):
+                results[i] = self.postprocess([prediction])
+        return results
+
+    @torch.no_grad()
+    def process_fast_batch(self, captchas: List[np.ndarray]) -> List[Result]:
+        with self.profiler.stage("fast_path"), self.profiler.trace("fast_path"):
+            inputs = torch.stack([self.fast_model.preprocess(captcha) for captcha in captchas])
+            return [
+                Result(text=text, confidence=confidence)
+                for text, confidence in self.fast_model.decode(self.fast_model(inputs))
+            ]
+
     @torch.no_grad()
     def predict(self, captchas: List[torch.Tensor]):
         return self.model(captchas)
@@ -60,28 +139,79 @@ class Processor(abc.ABC):
     def postprocess(self, prediction) -> Result:
         """Postprocess net output"""
 
+    def _handle_request(self, delivery: Delivery):
+        # control messages have no task, so they do not go through the failure handling of tasks
+        if is_control(delivery.body):
+            self._handle_control(delivery)
+        else:
+            self._handle_task_request(delivery)
+
+    def _handle_control(self, delivery: Delivery):
+        try:
+            control = ControlMessage.parse_raw(delivery.body)
+        except ValidationError:
+            nn_logger.exception(f"Invalid control message {delivery.body!r}")
+            delivery.reject()
+            return
+        nn_logger.info(f"Received {control}")
+        if control.command == "profile":
+            self.profiler.arm(control.requests)
+        else:
+            nn_logger.warning(f"Unknown command {control.command}")
+        delivery.ack()
+
     @handle_unhandled_exceptions
-    def _handle_request(self, channel: BlockingChannel, method: Method, properties: BasicProperties, body: bytes):
-        message = Message.parse_raw(body)
+    def _handle_task_request(self, delivery: Delivery):
+        if is_inline(delivery.body):
+            message, image = decode_inline(delivery.body)
+        else:
+            message, image = Message.parse_raw(delivery.body), None
+        with self.profiler.request():
+            self._handle_task(message, image)
+        # acked after the profiling record is finished, nothing can fail the request after the ack
+        delivery.ack()
+
+    def _handle_task(self, message: Message, inline_image: Optional[bytes] = None):
+        """Image is taken from the redis storage if it was not sent inside the message"""
+        started = monotonic()
         nn_logger.info(f"Received {message}")
-        task_tracker.update_status(message.task_id, status=TaskStatus.processing)
+        with self.profiler.stage("status_update"):
+            task_tracker.update_status(
+                message.task_id, status=TaskStatus.processing, timings={TaskStage.dequeued: time()}
+            )
 
-        redis_storage.set_namespace(message.storage_namespace)
-        try:
-            image = redis_storage.pop(message.task_id)
-        except KeyError as e:
-            nn_logger.exception(f"Task id {message.task_id} not found in redis storage")
-            raise ExpectedException(f"Image with key {message.task_id} not found") from e
+        if inline_image is not None:
+            with self.profiler.stage("decode"):
+                image = decode_image(inline_image)
+        else:
+            redis_storage.set_namespace(message.storage_namespace)
+            try:
+                # includes unpickling of the image
+                with self.profiler.stage("fetch"):
+                    image = redis_storage.pop(message.task_id)
+            except KeyError as e:
+                nn_logger.exception(f"Task id {message.task_id} not found in redis storage")
+                raise ExpectedException(f"Image with key {message.task_id} not found") from e
+        timings = {TaskStage.image_fetched: time()}
 
-        result = self.process(image)
-        task_tracker.publish_result(message.task_id, result)
-        task_tracker.update_status(message.task_id, status=TaskStatus.finished)
+        timings[TaskStage.inference_start] = time()
+        with self.profiler.stage("process"):
+            result = self.process(image)
+        timings[TaskStage.inference_end] = time()
+        with self.profiler.stage("publish"):
+            task_tracker.publish_result(message.task_id, result)
+            timings[TaskStage.finished] = time()
+            task_tracker.update_status(message.task_id, status=TaskStatus.finished, timings=timings)
 
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+        try:
+            solve_stats.record(message.storage_namespace, monotonic() - started)
+        except RedisError:
+            # stats are only used by admission control and must not fail a solved task
+            nn_logger.exception("Could not record solve time")
         nn_logger.info(f"Finished processing with a result: {result}")
 
     def start_consuming(self):
-        self.channel.start_consuming()
+        self.consumer.consume(self._handle_request)
 
 
 class FnsCaptchaProcessor(Processor):
@@ -0,0 +1,184 @@
+"""
+On-demand profiling of nn workers. Profiling of the next N requests is started without restart by
+
+    kill -USR1 <worker pid>                                        # PROFILE_REQUESTS requests
+    python -m capts.businesslogic.profiling fns --requests 50      # control message to one of the fns workers
+
+Every session writes into its own directory in PROFILE_DIR:
+    stages.jsonl          wall and cpu time of every stage of every request
+    summary.txt           mean and max time of every stage
+    torch_trace_N_*.json  operator level traces of the forward passes of the N-th request. Open in chrome://tracing
+    torch_ops.txt         operators sorted by self cpu time for every forward pass
+    allocations.txt       python allocations (numpy arrays included) grouped by line
+"""
+import argparse
+import json
+import os
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, process_time
+from typing import Dict, List, Optional
+
+import torch
+
+from capts.app.models import ControlMessage
+from capts.businesslogic.queue import captcha_type2queue, get_publishers
+from capts.config import CaptchaType, nn_logger
+
+
+class NullContext:
+    """No-op context manager. contextlib.nullcontext is not available in python 3.6"""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+# shared no-op context to not create objects when profiling is off
+NULL_CONTEXT = NullContext()
+
+
+class Profiler:
+    def __init__(self, output_dir: str):
+        self._output_dir = Path(output_dir)
+        self._requested = 0
+        self._remaining = 0
+        self._session_dir: Optional[Path] = None
+        self._records: List[Dict[str, Dict[str, float]]] = []
+        self._current: Optional[Dict[str, Dict[str, float]]] = None
+
+    def arm(self, requests: int):
+        """Profile next `requests` requests. Safe to call from a signal handler"""
+        if requests <= 0:
+            nn_logger.warning(f"Number of requests to profile should be positive, got {requests}")
+            return
+        self._requested = requests
+
+    def request(self):
+        """Context of one request. Starts a session if profiling was armed and no session is running"""
+        if self._requested and self._remaining > 0:
+            nn_logger.warning(f"Profiling is already running, request to profile {self._requested} requests is ignored")
+            self._requested = 0
+        elif self._requested:
+            try:
+                self._start_session()
+            except Exception:
+                self._abort_session()
+        if self._remaining <= 0:
+            return NULL_CONTEXT
+        return self._profile_request()
+
+    def stage(self, name: str):
+        if self._current is None:
+            return NULL_CONTEXT
+        return self._profile_stage(name)
+
+    def trace(self, name: str):
+        """Operator level torch profiler of the forward pass"""
+        if self._current is None:
+            return NULL_CONTEXT
+        return self._trace_torch(name)
+
+    def _start_session(self):
+        self._remaining, self._requested = self._requested, 0
+        self._session_dir = self._output_dir / f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+        self._session_dir.mkdir(parents=True, exist_ok=True)
+        self._records = []
+        tracemalloc.start()
+        nn_logger.info(f"Profiling next {self._remaining} requests into {self._session_dir}")
+
+    def _abort_session(self):
+        """Profiling must never fail a request, so errors of the profiler only stop the session"""
+        nn_logger.exception("Profiling failed, the session is stopped")
+        self._remaining = 0
+        self._current = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def _profile_request(self):
+        self._current = {}
+        try:
+            with self._profile_stage("total"):
+                yield
+        finally:
+            try:
+                self._save_record()
+            except Exception:
+                self._abort_session()
+
+    def _save_record(self):
+        record, self._current = self._current, None
+        self._records.append(record)
+        with open(self._session_dir / "stages.jsonl", "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self._remaining -= 1
+        if self._remaining <= 0:
+            self._finish_session()
+
+    @contextmanager
+    def _profile_stage(self, name: str):
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            self._current[name] = {"wall": perf_counter() - wall, "cpu": process_time() - cpu}
+
+    @contextmanager
+    def _trace_torch(self, name: str):
+        try:
+            profile = torch.autograd.profiler.profile(profile_memory=True)
+        except TypeError:
+            # memory profiling is not supported by old torch versions
+            profile = torch.autograd.profiler.profile()
+        with profile:
+            yield
+        try:
+            self._export_trace(profile, name)
+        except Exception:
+            nn_logger.exception(f"Could not export torch trace of {name}")
+
+    def _export_trace(self, profile: torch.autograd.profiler.profile, name: str):
+        index = len(self._records)
+        profile.export_chrome_trace(str(self._session_dir / f"torch_trace_{index}_{name}.json"))
+        with open(self._session_dir / "torch_ops.txt", "a") as f:
+            f.write(f"request {index} {name}\n{profile.key_averages().table(sort_by='self_cpu_time_total')}\n")
+
+    def _finish_session(self):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(self._session_dir / "allocations.txt", "w") as f:
+            f.write(f"traced memory: current {current} bytes, peak {peak} bytes\n")
+            f.write("\n".join(str(stat) for stat in snapshot.statistics("lineno")[:50]))
+
+        stages = defaultdict(list)
+        for record in self._records:
+            for name, times in record.items():
+                stages[name].append(times)
+        with open(self._session_dir / "summary.txt", "w") as f:
+            for name, times in stages.items():
+                walls, cpus = [t["wall"] * 1000 for t in times], [t["cpu"] * 1000 for t in times]
+                f.write(
+                    f"{name}: count {len(times)}, wall mean {sum(walls) / len(walls):.2f} ms max {max(walls):.2f} ms, "
+                    f"cpu mean {sum(cpus) / len(cpus):.2f} ms max {max(cpus):.2f} ms\n"
+                )
+        nn_logger.info(f"Profiling finished. Results are in {self._session_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Asks one of the workers to profile next requests")
+    parser.add_argument("net_type", choices=[CaptchaType.fns.name, CaptchaType.alcolicenziat.name])
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+    if args.requests <= 0:
+        parser.error("--requests should be positive")
+
+    get_publishers()[captcha_type2queue[args.net_type]].publish_message(
+        ControlMessage(command="profile", requests=args.requests)
+    )
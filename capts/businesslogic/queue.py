@@ -1,6 +1,8 @@
+import abc
 import os
 from itertools import count
 from time import sleep
+from typing import Callable, Dict, Iterable, NamedTuple
 
 import pika
 from pika import ConnectionParameters, PlainCredentials
@@ -8,10 +10,24 @@ from pika.adapters.blocking_connection import BlockingChannel, BlockingConnectio
 from pika.exceptions import AMQPConnectionError
 from pydantic import BaseModel
 
-from capts.config import RABBIT_LOGIN, RABBIT_PASSWORD, RABBIT_PORT, RABBIT_URL
+from capts.config import (
+    RABBIT_LOGIN,
+    RABBIT_PASSWORD,
+    RABBIT_PORT,
+    RABBIT_URL,
+    CaptchaType,
+)
 
 
 class Config:
+    # "rabbit" or "redis" (redis streams)
+    QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "rabbit")
+    CONSUMER_GROUP = os.environ.get("CONSUMER_GROUP", "capts")
+    STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 10))
+    STREAM_CLAIM_IDLE_MS = int(os.environ.get("STREAM_CLAIM_IDLE_MS", 60000))
+    STREAM_MAX_DELIVERIES = int(os.environ.get("STREAM_MAX_DELIVERIES", 3))
+    # dead letter streams are trimmed to about this number of entries
+    STREAM_DEAD_LETTER_MAXLEN = int(os.environ.get("STREAM_DEAD_LETTER_MAXLEN", 10000))
     EXCHANGE = os.environ.get("EXCHANGE", "exchange")
     EXCHANGE_DEAD_LETTER = os.environ.get("EXCHANGE_DEAD_LETTER", "exchange-dead-letter")
     FNS_QUEUE = os.environ.get("FNS_QUEUE", "fns-queue")
@@ -20,29 +36,116 @@ class Config:
     ALCO_QUEUE_ROUTING_KEY = "alco"
 
 
-def send_object(channel: BlockingChannel, app_model: BaseModel, exchange: str, routing_key: str):
+captcha_type2queue = {CaptchaType.fns.name: Config.FNS_QUEUE, CaptchaType.alcolicenziat.name: Config.ALCO_QUEUE}
+
+
+def serialize(app_model: BaseModel) -> bytes:
+    return app_model.json(by_alias=True, exclude_unset=True).encode("utf-8")
+
+
+def send_body(channel: BlockingChannel, body: bytes, exchange: str, routing_key: str):
     channel.basic_publish(
         exchange=exchange,
         routing_key=routing_key,
-        body=app_model.json(by_alias=True, exclude_unset=True),
+        body=body,
         properties=pika.BasicProperties(delivery_mode=2),
     )
 
 
-class MessagePublisher:
-    def __init__(self, channel: BlockingChannel, exchange: str, routing_key: str):
+def send_object(channel: BlockingChannel, app_model: BaseModel, exchange: str, routing_key: str):
+    send_body(channel, serialize(app_model), exchange, routing_key)
+
+
+class QueueStats(NamedTuple):
+    message_count: int
+    consumer_count: int
+
+
+class Delivery(abc.ABC):
+    """Received message which should be either acknowledged or rejected"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    @abc.abstractmethod
+    def ack(self):
+        """Remove the message from the queue"""
+
+    @abc.abstractmethod
+    def reject(self):
+        """Move the message to the dead letter queue"""
+
+
+class MessagePublisher(abc.ABC):
+    @abc.abstractmethod
+    def publish_body(self, body: bytes):
+        """Put the raw message into the queue"""
+
+    def publish_message(self, object_: BaseModel):
+        self.publish_body(serialize(object_))
+
+    def publish_messages(self, objects: Iterable[BaseModel]):
+        for object_ in objects:
+            self.publish_message(object_)
+
+    @abc.abstractmethod
+    def get_queue_stats(self) -> QueueStats:
+        """Number of waiting messages and consumers of the queue"""
+
+
+class MessageConsumer(abc.ABC):
+    @abc.abstractmethod
+    def consume(self, callback: Callable[[Delivery], None]):
+        """Blocks and calls the callback for every received message"""
+
+
+class RabbitMessagePublisher(MessagePublisher):
+    def __init__(self, channel: BlockingChannel, exchange: str, routing_key: str, queue: str):
         self._channel = channel
         self._exchange = exchange
         self._routing_key = routing_key
+        self._queue = queue
 
-    def publish_message(self, object_: BaseModel):
-        send_object(
+    def publish_body(self, body: bytes):
+        send_body(
             channel=self._channel,
-            app_model=object_,
+            body=body,
             exchange=self._exchange,
             routing_key=self._routing_key,
         )
 
+    def get_queue_stats(self) -> QueueStats:
+        method = self._channel.queue_declare(queue=self._queue, passive=True).method
+        return QueueStats(message_count=method.message_count, consumer_count=method.consumer_count)
+
+
+class RabbitDelivery(Delivery):
+    def __init__(self, channel: BlockingChannel, delivery_tag: int, body: bytes):
+        super().__init__(body)
+        self._channel = channel
+        self._delivery_tag = delivery_tag
+
+    def ack(self):
+        self._channel.basic_ack(delivery_tag=self._delivery_tag)
+
+    def reject(self):
+        self._channel.basic_reject(delivery_tag=self._delivery_tag, requeue=False)
+
+
+class RabbitMessageConsumer(MessageConsumer):
+    def __init__(self, channel: BlockingChannel, queue: str, prefetch_count: int = 1):
+        self._channel = channel
+        self._queue = queue
+        self._prefetch_count = prefetch_count
+
+    def consume(self, callback: Callable[[Delivery], None]):
+        def on_message(channel, method, properties, body):
+            callback(RabbitDelivery(channel, method.delivery_tag, body))
+
+        self._channel.basic_qos(prefetch_count=self._prefetch_count)
+        self._channel.basic_consume(queue=self._queue, on_message_callback=on_message)
+        self._channel.start_consuming()
+
 
 def init_exchange(channel: BlockingChannel, exchange: str, type_: str):
     channel.exchange_declare(
@@ -142,3 +245,32 @@ def get_publisher_channel():
 
 def get_consumer_channel():
     return get_channel(RABBIT_URL, RABBIT_PORT, RABBIT_LOGIN, RABBIT_PASSWORD, 60)
+
+
+def get_publishers() -> Dict[str, MessagePublisher]:
+    """Returns publishers of the configured backend by queue name"""
+    if Config.QUEUE_BACKEND == "redis":
+        # imported here as redis_queue depends on this module
+        from capts.businesslogic.redis_queue import get_redis_publishers
+
+        return get_redis_publishers([Config.FNS_QUEUE, Config.ALCO_QUEUE])
+
+    channel = get_publisher_channel()
+    return {
+        Config.FNS_QUEUE: RabbitMessagePublisher(
+            channel, Config.EXCHANGE, Config.FNS_QUEUE_ROUTING_KEY, Config.FNS_QUEUE
+        ),
+        Config.ALCO_QUEUE: RabbitMessagePublisher(
+            channel, Config.EXCHANGE, Config.ALCO_QUEUE_ROUTING_KEY, Config.ALCO_QUEUE
+        ),
+    }
+
+
+def get_consumer(queue: str) -> MessageConsumer:
+    """Returns consumer of the configured backend for the queue"""
+    if Config.QUEUE_BACKEND == "redis":
+        from capts.businesslogic.redis_queue import get_redis_consumer
+
+        return get_redis_consumer(queue)
+
+    return RabbitMessageConsumer(get_consumer_channel(), queue)
@@ -0,0 +1,229 @@
+import os
+import socket
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Sequence
+
+from pydantic import BaseModel
+from redis import Redis
+from redis.exceptions import RedisError, ResponseError
+
+from capts.businesslogic.envelope import EnvelopeError, parse_message
+from capts.businesslogic.queue import (
+    Config,
+    Delivery,
+    MessageConsumer,
+    MessagePublisher,
+    QueueStats,
+    serialize,
+)
+from capts.businesslogic.task import TaskNotRegisteredError, TaskStatus
+from capts.config import REDIS_URL, nn_logger, task_tracker
+
+BODY_FIELD = b"body"
+
+
+def dead_letter_stream(stream: str) -> str:
+    return f"{stream}-dead-letter"
+
+
+def fail_task(body: bytes):
+    """Marks the task of the message as failed, so clients do not wait for it until it expires"""
+    try:
+        message = parse_message(body)
+        task_tracker.update_status(message.task_id, status=TaskStatus.failed)
+    except (ValueError, EnvelopeError, TaskNotRegisteredError):
+        nn_logger.exception(f"Could not mark the task of {body[:100]!r} as failed")
+
+
+class RedisStreamPublisher(MessagePublisher):
+    """Publishes messages to a redis stream which is consumed by a consumer group.
+
+    Consumers which have not read the stream for `claim_idle_ms` are not counted as live ones. Names of consumers
+    are unique for every process, so names of stopped workers stay in the group until they are deleted.
+    """
+
+    def __init__(self, redis: Redis, stream: str, group: str, claim_idle_ms: int = 60000):
+        self._redis = redis
+        self._stream = stream
+        self._group = group
+        self._claim_idle_ms = claim_idle_ms
+
+    def publish_body(self, body: bytes):
+        self._redis.xadd(self._stream, {BODY_FIELD: body})
+
+    def publish_messages(self, objects: Iterable[BaseModel]):
+        with self._redis.pipeline(transaction=False) as pipe:
+            for object_ in objects:
+                pipe.xadd(self._stream, {BODY_FIELD: serialize(object_)})
+            pipe.execute()
+
+    def get_queue_stats(self) -> QueueStats:
+        # acknowledged entries are deleted, so stream length is the number of waiting and processing messages
+        with self._redis.pipeline(transaction=False) as pipe:
+            pipe.xlen(self._stream)
+            pipe.xinfo_consumers(self._stream, self._group)
+            try:
+                length, consumers = pipe.execute()
+            except ResponseError:
+                # stream and group are created by consumers. No group means no consumers yet
+                return QueueStats(message_count=0, consumer_count=0)
+        live_consumers = sum(consumer["idle"] < self._claim_idle_ms for consumer in consumers)
+        return QueueStats(message_count=length, consumer_count=live_consumers)
+
+
+class RedisStreamDelivery(Delivery):
+    def __init__(
+        self, redis: Redis, stream: str, group: str, entry_id: bytes, body: bytes, dead_letter_maxlen: int = 10000
+    ):
+        super().__init__(body)
+        self._redis = redis
+        self._stream = stream
+        self._group = group
+        self._entry_id = entry_id
+        self._dead_letter_maxlen = dead_letter_maxlen
+
+    def ack(self):
+        with self._redis.pipeline() as pipe:
+            pipe.xack(self._stream, self._group, self._entry_id)
+            pipe.xdel(self._stream, self._entry_id)
+            pipe.execute()
+
+    def reject(self):
+        with self._redis.pipeline() as pipe:
+            pipe.xadd(
+                dead_letter_stream(self._stream),
+                {BODY_FIELD: self.body},
+                maxlen=self._dead_letter_maxlen,
+                approximate=True,
+            )
+            pipe.xack(self._stream, self._group, self._entry_id)
+            pipe.xdel(self._stream, self._entry_id)
+            pipe.execute()
+
+
+class RedisStreamConsumer(MessageConsumer):
+    """Consumes a redis stream as a member of a consumer group.
+
+    Entries are read in batches of `batch_size`. Entries which were delivered to some consumer but were not
+    acknowledged for `claim_idle_ms` (e.g. the consumer died) are claimed and processed again. Entries delivered
+    `max_deliveries` times are moved to the dead letter stream and their tasks are marked as failed.
+    Dead letter stream is trimmed to about `dead_letter_maxlen` entries.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        stream: str,
+        group: str,
+        consumer: str,
+        batch_size: int = 10,
+        block_ms: int = 5000,
+        claim_idle_ms: int = 60000,
+        max_deliveries: int = 3,
+        dead_letter_maxlen: int = 10000,
+    ):
+        self._redis = redis
+        self._stream = stream
+        self._group = group
+        self._consumer = consumer
+        self._batch_size = batch_size
+        self._block_ms = block_ms
+        self._claim_idle_ms = claim_idle_ms
+        self._max_deliveries = max_deliveries
+        self._dead_letter_maxlen = dead_letter_maxlen
+
+    def _ensure_group(self):
+        try:
+            self._redis.xgroup_create(self._stream, self._group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _make_delivery(self, entry_id: bytes, fields: Dict[bytes, bytes]) -> RedisStreamDelivery:
+        return RedisStreamDelivery(
+            self._redis, self._stream, self._group, entry_id, fields[BODY_FIELD], self._dead_letter_maxlen
+        )
+
+    def _read_new(self) -> List[RedisStreamDelivery]:
+        response = self._redis.xreadgroup(
+            self._group, self._consumer, {self._stream: ">"}, count=self._batch_size, block=self._block_ms
+        )
+        return [self._make_delivery(entry_id, fields) for _, entries in response for entry_id, fields in entries]
+
+    def _claim_stale(self) -> List[RedisStreamDelivery]:
+        pending = self._redis.xpending_range(self._stream, self._group, "-", "+", self._batch_size)
+        stale = [entry for entry in pending if entry["time_since_delivered"] >= self._claim_idle_ms]
+        exhausted = [entry["message_id"] for entry in stale if entry["times_delivered"] >= self._max_deliveries]
+        if exhausted:
+            self._dead_letter(exhausted)
+
+        to_claim = [entry["message_id"] for entry in stale if entry["times_delivered"] < self._max_deliveries]
+        if not to_claim:
+            return []
+        claimed = self._redis.xclaim(self._stream, self._group, self._consumer, self._claim_idle_ms, to_claim)
+        # entries deleted from the stream come back as nil or without fields, depending on the redis version.
+        # They are only removed from pending
+        claimed = [(entry_id, fields) for entry_id, fields in claimed if fields]
+        claimed_ids = {entry_id for entry_id, _ in claimed}
+        deleted = [entry_id for entry_id in to_claim if entry_id not in claimed_ids]
+        if deleted:
+            self._redis.xack(self._stream, self._group, *deleted)
+        return [self._make_delivery(entry_id, fields) for entry_id, fields in claimed]
+
+    def _dead_letter(self, entry_ids: Sequence[bytes]):
+        for entry_id in entry_ids:
+            entries = self._redis.xrange(self._stream, min=entry_id, max=entry_id)
+            if entries:
+                nn_logger.warning(f"Entry {entry_id} of {self._stream} exceeded {self._max_deliveries} deliveries")
+                delivery = self._make_delivery(*entries[0])
+                delivery.reject()
+                fail_task(delivery.body)
+            else:
+                self._redis.xack(self._stream, self._group, entry_id)
+
+    def _delete_consumer(self):
+        """Removes the consumer from the group unless it has entries which should be claimed by other consumers"""
+        pending = self._redis.xpending_range(self._stream, self._group, "-", "+", 1, consumername=self._consumer)
+        if pending:
+            nn_logger.warning(f"Consumer {self._consumer} is not deleted because it has pending entries")
+            return
+        self._redis.xgroup_delconsumer(self._stream, self._group, self._consumer)
+
+    def consume(self, callback: Callable[[Delivery], None]):
+        self._ensure_group()
+        last_claim = monotonic()
+        try:
+            while True:
+                deliveries = self._read_new()
+                if monotonic() - last_claim > self._claim_idle_ms / 1000:
+                    last_claim = monotonic()
+                    deliveries.extend(self._claim_stale())
+                for delivery in deliveries:
+                    callback(delivery)
+        finally:
+            try:
+                self._delete_consumer()
+            except RedisError:
+                nn_logger.exception(f"Could not delete consumer {self._consumer}")
+
+
+def get_redis_publishers(streams: Sequence[str]) -> Dict[str, MessagePublisher]:
+    redis = Redis.from_url(REDIS_URL)
+    return {
+        stream: RedisStreamPublisher(redis, stream, Config.CONSUMER_GROUP, claim_idle_ms=Config.STREAM_CLAIM_IDLE_MS)
+        for stream in streams
+    }
+
+
+def get_redis_consumer(stream: str) -> MessageConsumer:
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    return RedisStreamConsumer(
+        Redis.from_url(REDIS_URL),
+        stream,
+        Config.CONSUMER_GROUP,
+        consumer,
+        batch_size=Config.STREAM_BATCH_SIZE,
+        claim_idle_ms=Config.STREAM_CLAIM_IDLE_MS,
+        max_deliveries=Config.STREAM_MAX_DELIVERIES,
+        dead_letter_maxlen=Config.STREAM_DEAD_LETTER_MAXLEN,
+    )
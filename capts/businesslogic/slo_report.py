@@ -0,0 +1,58 @@
+import argparse
+from collections import defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from capts.businesslogic.task import Task, TaskStage, TaskStatus
+from capts.config import task_tracker
+
+# report interval name -> (from stage, to stage)
+intervals: Dict[str, Tuple[TaskStage, TaskStage]] = {
+    "queue": (TaskStage.received, TaskStage.dequeued),
+    "image_fetch": (TaskStage.dequeued, TaskStage.image_fetched),
+    "inference": (TaskStage.inference_start, TaskStage.inference_end),
+    "publish": (TaskStage.inference_end, TaskStage.finished),
+    "total": (TaskStage.received, TaskStage.finished),
+}
+
+
+def collect_durations(tasks: Sequence[Task]) -> Dict[str, Dict[str, List[float]]]:
+    """Returns durations in milliseconds grouped by captcha type and interval name"""
+    durations = defaultdict(lambda: defaultdict(list))
+    for task in tasks:
+        if task.status != TaskStatus.finished:
+            continue
+        for name, (start, end) in intervals.items():
+            if start in task.timings and end in task.timings:
+                durations[task.captcha_type or "unknown"][name].append((task.timings[end] - task.timings[start]) * 1000)
+    return durations
+
+
+def format_report(durations: Dict[str, Dict[str, List[float]]], percentiles: Sequence[float]) -> str:
+    header = ["type", "stage", "count"] + [f"p{p:g}, ms" for p in percentiles]
+    rows = [header]
+    for captcha_type in sorted(durations):
+        for name in intervals:
+            values = durations[captcha_type].get(name)
+            if not values:
+                continue
+            rows.append(
+                [captcha_type, name, str(len(values))] + [f"{v:.1f}" for v in np.percentile(values, percentiles)]
+            )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency percentiles per stage for recently processed captchas")
+    parser.add_argument("--tasks", type=int, default=1000, help="number of recent tasks to sample")
+    parser.add_argument("--percentiles", type=float, nargs="+", default=[50, 90, 99])
+    args = parser.parse_args()
+
+    tasks = task_tracker.get_tasks(task_tracker.get_recent_task_ids(args.tasks))
+    durations = collect_durations(tasks)
+    if not durations:
+        print(f"No finished tasks with timings among {len(tasks)} sampled")
+    else:
+        print(format_report(durations, args.percentiles))
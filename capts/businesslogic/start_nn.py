@@ -1,34 +1,57 @@
 import argparse
-
-from capts.businesslogic.nets import DeclarationCaptchasNet, FNSCaptchasNet
-from capts.businesslogic.processor import AlcoCaptchaProcessor, FnsCaptchaProcessor
-from capts.businesslogic.queue import Config, get_consumer_channel
-from capts.config import CaptchaType, nn_logger
+import signal
+import sys
+from typing import Optional
+
+from capts.businesslogic.nets import (
+    CTCCaptchasNet,
+    DeclarationCaptchasNet,
+    FNSCaptchasNet,
+)
+from capts.businesslogic.processor import (
+    AlcoCaptchaProcessor,
+    FnsCaptchaProcessor,
+    Processor,
+)
+from capts.businesslogic.queue import Config, captcha_type2queue, get_consumer
+from capts.config import PROFILE_REQUESTS, CaptchaType, nn_logger
 
 captcha_type2processor = {CaptchaType.fns.name: FnsCaptchaProcessor}
 
 
+def load_processor(net_type: str, fast_weights: Optional[str] = None, fast_threshold: float = 0.9) -> Processor:
+    """Loads processor without consumer"""
+    if net_type == CaptchaType.fns.name:
+        vocab_path = "/weights/vocab_fns.pkl"
+        model = FNSCaptchasNet(vocab_path, "/weights/fns_model_weights.ptr").eval()
+        ProcessorClass = FnsCaptchaProcessor
+    elif net_type == CaptchaType.alcolicenziat.name:
+        vocab_path = "weights/vocab_declaration.pkl"
+        model = DeclarationCaptchasNet(vocab_path, "weights/declaration_model_weigths.ptr").eval()
+        ProcessorClass = AlcoCaptchaProcessor
+    else:
+        raise NotImplementedError
+    fast_model = CTCCaptchasNet(vocab_path, fast_weights).eval() if fast_weights else None
+    nn_logger.info("Initialized model" if fast_model is None else "Initialized model with fast path")
+
+    return ProcessorClass(model=model, fast_model=fast_model, fast_threshold=fast_threshold)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument("net_type", choices=[CaptchaType.fns.name, CaptchaType.alcolicenziat.name])
+    parser.add_argument("--fast-weights", help="weights of the fast path recognizer. Fast path is disabled if not set")
+    parser.add_argument("--fast-threshold", type=float, default=0.9, help="min confidence to accept fast path result")
     args = parser.parse_args()
 
-    if args.net_type == CaptchaType.fns.name:
-        model = FNSCaptchasNet("/weights/vocab_fns.pkl", "/weights/fns_model_weights.ptr").eval()
-        ProcessorClass = FnsCaptchaProcessor
-        in_queue = Config.FNS_QUEUE
-    elif args.net_type == CaptchaType.alcolicenziat.name:
-        model = DeclarationCaptchasNet("weights/vocab_declaration.pkl", "weights/declaration_model_weigths.ptr").eval()
-        ProcessorClass = AlcoCaptchaProcessor
-        in_queue = Config.ALCO_QUEUE
-    else:
-        raise NotImplementedError
-    nn_logger.info("Initialized model")
-
-    channel = get_consumer_channel()
-    nn_logger.info(f"Connected to channel {channel}")
+    processor = load_processor(args.net_type, args.fast_weights, args.fast_threshold)
 
-    processor = ProcessorClass(model=model, channel=channel, in_queue=in_queue)
+    processor.consumer = get_consumer(captcha_type2queue[args.net_type])
+    nn_logger.info(f"Connected to {Config.QUEUE_BACKEND} queue {captcha_type2queue[args.net_type]}")
+    # profile next requests on `kill -USR1 <pid>`
+    signal.signal(signal.SIGUSR1, lambda signum, frame: processor.profiler.arm(PROFILE_REQUESTS))
+    # stop on `docker stop` the same way as on ctrl+c, so the consumer can clean up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     nn_logger.info("Listening to messages")
     processor.start_consuming()
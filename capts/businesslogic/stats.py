@@ -0,0 +1,48 @@
+from typing import Optional, Sequence
+
+from capts.businesslogic.task import RedisNotInitializedError
+from capts.sharding import ShardedRedis
+
+
+class SolveTimeStats:
+    """Rolling window of the most recent solve durations (in seconds) for every captcha type"""
+
+    key_prefix = "capts|solve_times"
+
+    def __init__(self, redis: ShardedRedis, window: int = 100, ttl: Optional[int] = None):
+        self._redis = redis
+        self._window = window
+        self._ttl = ttl
+
+    @classmethod
+    def from_url(cls, url: str, window: int = 100, ttl: Optional[int] = None):
+        return cls.from_urls([url], window=window, ttl=ttl)
+
+    @classmethod
+    def from_urls(
+        cls, urls: Sequence[str], previous_urls: Sequence[str] = (), window: int = 100, ttl: Optional[int] = None
+    ):
+        try:
+            redis = ShardedRedis.from_urls(urls, previous_urls)
+        except ValueError as e:
+            raise RedisNotInitializedError(f"Could not initialize redis from urls: {urls}") from e
+        return cls(redis, window, ttl)
+
+    def _get_key(self, captcha_type: str) -> str:
+        return f"{self.key_prefix}|{captcha_type}"
+
+    def record(self, captcha_type: str, seconds: float):
+        key = self._get_key(captcha_type)
+        with self._redis.for_key(key).pipeline() as pipe:
+            pipe.lpush(key, seconds)
+            pipe.ltrim(key, 0, self._window - 1)
+            if self._ttl:
+                pipe.expire(key, self._ttl)
+            pipe.execute()
+
+    def mean(self, captcha_type: str) -> Optional[float]:
+        key = self._get_key(captcha_type)
+        values = self._redis.for_key(key).lrange(key, 0, -1)
+        if not values:
+            return None
+        return sum(float(value) for value in values) / len(values)
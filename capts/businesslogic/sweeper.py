@@ -0,0 +1,158 @@
+import argparse
+from dataclasses import dataclass
+from itertools import islice
+from time import sleep
+from typing import Iterable, Iterator, List, Sequence
+
+from redis import Redis
+
+from capts.config import (
+    IMAGE_TTL,
+    TASK_TTL,
+    CaptchaType,
+    redis_shards,
+    redis_storage,
+    sweeper_logger,
+)
+from capts.storage import RedisStorage
+
+# task keys are bare uuid4 strings
+TASK_KEY_PATTERN = "????????-????-????-????-????????????"
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+@dataclass
+class SweepReport:
+    registry_entries_removed: int = 0
+    orphan_chunk_lists_removed: int = 0
+    keys_without_ttl_expired: int = 0
+    bytes_reclaimed: int = 0
+
+    def __str__(self):
+        return (
+            f"removed {self.registry_entries_removed} registry entries, "
+            f"{self.orphan_chunk_lists_removed} orphan chunk lists; "
+            f"set ttl on {self.keys_without_ttl_expired} keys; "
+            f"reclaimed {self.bytes_reclaimed} bytes"
+        )
+
+
+class Sweeper:
+    """Reconciles keys written by `RedisStorage` and `TaskTracker` against their TTLs.
+
+    Registry entries can not expire by themselves, so entries whose chunks have expired are removed. Chunk lists
+    without registry entry are removed. Keys written before TTLs were introduced get one. Recent tasks lists are
+    not swept: they are capped, expire and ids of expired tasks are skipped when tasks are read.
+    All keys are iterated with incremental SCAN/HSCAN so redis is never blocked. One sweeper handles one redis
+    node, every node keeps its own registries.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        storage: RedisStorage,
+        namespaces: Sequence[str],
+        task_ttl: int,
+        image_ttl: int,
+        scan_count: int = 1000,
+    ):
+        self._redis = redis
+        self._storage = storage
+        self._namespaces = namespaces
+        self._task_ttl = task_ttl
+        self._image_ttl = image_ttl
+        self._scan_count = scan_count
+
+    def sweep(self) -> SweepReport:
+        report = SweepReport()
+        for namespace in self._namespaces:
+            self._sweep_registry(namespace, report)
+        self._sweep_chunk_lists(report)
+        self._sweep_tasks(report)
+        return report
+
+    def _registry_name(self, namespace: str) -> str:
+        return f"{namespace}|{self._storage.registry_name}"
+
+    def _chunks_name(self, namespace: str, key: str) -> str:
+        return f"{namespace}|{key}|{self._storage.chunks_suffix}"
+
+    def _memory_usage(self, key: str) -> int:
+        return self._redis.memory_usage(key) or 0
+
+    def _sweep_registry(self, namespace: str, report: SweepReport):
+        registry = self._registry_name(namespace)
+        memory_before = self._memory_usage(registry)
+        keys = (key.decode("utf-8") for key, _ in self._redis.hscan_iter(registry, count=self._scan_count))
+        for batch in batched(keys, self._scan_count):
+            with self._redis.pipeline(transaction=False) as pipe:
+                for key in batch:
+                    pipe.exists(self._chunks_name(namespace, key))
+                exist = pipe.execute()
+            expired = [key for key, exists in zip(batch, exist) if not exists]
+            if expired:
+                report.registry_entries_removed += self._redis.hdel(registry, *expired)
+        report.bytes_reclaimed += max(memory_before - self._memory_usage(registry), 0)
+
+    def _sweep_chunk_lists(self, report: SweepReport):
+        suffix = f"|{self._storage.chunks_suffix}"
+        names = (name.decode("utf-8") for name in self._redis.scan_iter(match=f"*{suffix}", count=self._scan_count))
+        for batch in batched(names, self._scan_count):
+            with self._redis.pipeline(transaction=False) as pipe:
+                for name in batch:
+                    namespace, key = name[: -len(suffix)].split("|", 1)
+                    pipe.hexists(self._registry_name(namespace), key)
+                    pipe.ttl(name)
+                replies = pipe.execute()
+            for name, registered, ttl in zip(batch, replies[::2], replies[1::2]):
+                if not registered:
+                    report.bytes_reclaimed += self._memory_usage(name)
+                    report.orphan_chunk_lists_removed += self._redis.delete(name)
+                elif ttl == -1:
+                    report.keys_without_ttl_expired += self._redis.expire(name, self._image_ttl)
+
+    def _sweep_tasks(self, report: SweepReport):
+        ids = self._redis.scan_iter(match=TASK_KEY_PATTERN, count=self._scan_count)
+        for batch in batched(ids, self._scan_count):
+            with self._redis.pipeline(transaction=False) as pipe:
+                for id_ in batch:
+                    pipe.ttl(id_)
+                ttls = pipe.execute()
+            with self._redis.pipeline(transaction=False) as pipe:
+                for id_, ttl in zip(batch, ttls):
+                    if ttl == -1:
+                        pipe.expire(id_, self._task_ttl)
+                report.keys_without_ttl_expired += sum(pipe.execute())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Removes orphaned images and tasks from redis")
+    parser.add_argument("--interval", type=int, default=600, help="seconds between sweeps")
+    parser.add_argument("--once", action="store_true", help="sweep once and exit")
+    args = parser.parse_args()
+
+    namespaces = [captcha_type.name for captcha_type in CaptchaType]
+    sweepers = [
+        (redis, Sweeper(redis, redis_storage, namespaces, task_ttl=TASK_TTL, image_ttl=IMAGE_TTL))
+        for redis in redis_shards.nodes
+    ]
+    while True:
+        for redis, sweeper in sweepers:
+            used_memory_before = redis.info("memory")["used_memory"]
+            report = sweeper.sweep()
+            used_memory_after = redis.info("memory")["used_memory"]
+            sweeper_logger.info(
+                f"Sweep of {redis} finished: {report}. "
+                f"Used memory {used_memory_before} -> {used_memory_after} bytes"
+            )
+        if args.once:
+            break
+        sleep(args.interval)
@@ -1,12 +1,14 @@
 import dataclasses
 import json
 import uuid
+from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Optional, Union
+from time import time
+from typing import Dict, List, Optional, Sequence, Union
 from uuid import uuid4
 
-from redis import Redis
+from capts.sharding import ShardedRedis
 
 
 class TaskStatus(Enum):
@@ -16,6 +18,15 @@ class TaskStatus(Enum):
     failed = auto()
 
 
+class TaskStage(Enum):
+    received = auto()
+    dequeued = auto()
+    image_fetched = auto()
+    inference_start = auto()
+    inference_end = auto()
+    finished = auto()
+
+
 @dataclass
 class Result:
     text: str = ""
@@ -28,19 +39,33 @@ class Task:
         id: Optional[Union[uuid.UUID, str]] = None,
         status: TaskStatus = TaskStatus.received,
         result: Result = Result(),
+        captcha_type: str = "",
+        timings: Optional[Dict[TaskStage, float]] = None,
     ):
         self.id = str(uuid4()) if id is None else str(id)
         self.status = status
         self.result = result
+        self.captcha_type = captcha_type
+        self.timings = {} if timings is None else timings
 
     def to_json(self) -> str:
-        return json.dumps({"id": self.id, "status": self.status.value, "result": dataclasses.asdict(self.result)})
+        return json.dumps(
+            {
+                "id": self.id,
+                "status": self.status.value,
+                "result": dataclasses.asdict(self.result),
+                "captcha_type": self.captcha_type,
+                # unix timestamps with milliseconds precision
+                "timings": {stage.name: round(timestamp, 3) for stage, timestamp in self.timings.items()},
+            }
+        )
 
     @classmethod
     def from_json(cls, json_string: str):
         data = json.loads(json_string)
         data["status"] = TaskStatus(data["status"])
         data["result"] = Result(**data["result"])
+        data["timings"] = {TaskStage[stage]: timestamp for stage, timestamp in data.get("timings", {}).items()}
         return cls(**data)
 
 
@@ -53,28 +78,47 @@ class RedisNotInitializedError(Exception):
 
 
 class TaskTracker:
-    def __init__(self, redis: Redis):
+    """Stores every task on the redis node chosen by the task id. Every node keeps its own recent tasks list"""
+
+    recent_tasks_key = "capts|recent_tasks"
+
+    def __init__(self, redis: ShardedRedis, recent_tasks_limit: int = 10000, ttl: Optional[int] = None):
         self._redis = redis
+        self._recent_tasks_limit = recent_tasks_limit
+        self._ttl = ttl
+
+    @classmethod
+    def from_url(cls, url: str, ttl: Optional[int] = None):
+        return cls.from_urls([url], ttl=ttl)
 
     @classmethod
-    def from_url(cls, url: str):
+    def from_urls(cls, urls: Sequence[str], previous_urls: Sequence[str] = (), ttl: Optional[int] = None):
         try:
-            redis = Redis.from_url(url)
+            redis = ShardedRedis.from_urls(urls, previous_urls)
         except ValueError as e:
-            raise RedisNotInitializedError(f"Could not initialize redis from url: {url}") from e
-        return cls(redis)
+            raise RedisNotInitializedError(f"Could not initialize redis from urls: {urls}") from e
+        return cls(redis, ttl=ttl)
 
     def register_task(self, task: Task):
-        self._push_task(task)
-
-    def update_status(self, id_: str, status: TaskStatus):
+        task.timings.setdefault(TaskStage.received, time())
+        with self._redis.for_key(task.id).pipeline() as pipe:
+            pipe.set(task.id, task.to_json(), ex=self._ttl)
+            pipe.lpush(self.recent_tasks_key, task.id)
+            pipe.ltrim(self.recent_tasks_key, 0, self._recent_tasks_limit - 1)
+            if self._ttl:
+                pipe.expire(self.recent_tasks_key, self._ttl)
+            pipe.execute()
+
+    def update_status(self, id_: str, status: TaskStatus, timings: Optional[Dict[TaskStage, float]] = None):
         task = self.get_task(id_)
         task.status = status
+        task.timings.update(timings or {})
         self._push_task(task)
 
-    def publish_result(self, id_: str, result: Result):
+    def publish_result(self, id_: str, result: Result, timings: Optional[Dict[TaskStage, float]] = None):
         task = self.get_task(id_)
         task.result = result
+        task.timings.update(timings or {})
         self._push_task(task)
 
     def get_status(self, id_: str) -> TaskStatus:
@@ -82,9 +126,37 @@ class TaskTracker:
         return task.status
 
     def get_task(self, id_: str) -> Task:
-        if not self._redis.exists(id_):
-            raise TaskNotRegisteredError(f"Missing task with id {id_}")
-        return Task.from_json(self._redis.get(id_))
+        for redis in self._redis.candidates(id_):
+            data = redis.get(id_)
+            if data is not None:
+                return Task.from_json(data)
+        raise TaskNotRegisteredError(f"Missing task with id {id_}")
+
+    def get_tasks(self, ids: List[str]) -> List[Task]:
+        """Returns tasks that are still registered in one round trip per node"""
+        node2ids = defaultdict(list)
+        for id_ in ids:
+            node2ids[self._redis.for_key(id_)].append(id_)
+        tasks, missing = [], []
+        for redis, node_ids in node2ids.items():
+            for id_, data in zip(node_ids, redis.mget(node_ids)):
+                if data is not None:
+                    tasks.append(Task.from_json(data))
+                else:
+                    missing.append(id_)
+        # tasks which were not moved to their new nodes yet
+        for id_ in missing:
+            for redis in self._redis.candidates(id_)[1:]:
+                data = redis.get(id_)
+                if data is not None:
+                    tasks.append(Task.from_json(data))
+        return tasks
+
+    def get_recent_task_ids(self, n: int) -> List[str]:
+        """Returns up to `n` recent task ids from every node"""
+        return [
+            id_.decode("utf-8") for redis in self._redis.nodes for id_ in redis.lrange(self.recent_tasks_key, 0, n - 1)
+        ]
 
     def _push_task(self, task: Task):
-        self._redis.set(task.id, task.to_json())
+        self._redis.for_key(task.id).set(task.id, task.to_json(), ex=self._ttl)
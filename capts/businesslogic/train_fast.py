@@ -0,0 +1,140 @@
+"""
+Training and evaluation of the fast path recognizer (`CTCCaptchasNet`).
+
+Dataset is a directory of labeled captcha images. Label is the file name before the first underscore,
+e.g. `a5k2z_0001.png` or `a5k2z.png`
+
+    python -m capts.businesslogic.train_fast train fns --data captchas/fns --out /weights/fns_fast_weights.ptr
+    python -m capts.businesslogic.train_fast eval fns --data captchas/test --fast-weights /weights/fns_fast_weights.ptr
+"""
+import argparse
+import random
+from pathlib import Path
+from time import perf_counter
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from capts.businesslogic.nets import CTCCaptchasNet
+from capts.businesslogic.start_nn import load_processor
+from capts.config import CaptchaType
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".bmp"}
+captcha_type2vocab = {
+    CaptchaType.fns.name: "/weights/vocab_fns.pkl",
+    CaptchaType.alcolicenziat.name: "weights/vocab_declaration.pkl",
+}
+
+
+def load_dataset(path: str) -> List[Tuple[np.ndarray, str]]:
+    files = sorted(file for file in Path(path).iterdir() if file.suffix.lower() in IMAGE_SUFFIXES)
+    return [(np.array(Image.open(file).convert("RGB")), file.stem.split("_")[0]) for file in files]
+
+
+def make_batch(net: CTCCaptchasNet, samples: List[Tuple[np.ndarray, str]]):
+    inputs = torch.stack([net.preprocess(image) for image, _ in samples])
+    targets = torch.tensor([index for _, label in samples for index in net.encode(label)], dtype=torch.long)
+    target_lengths = torch.tensor([len(label) for _, label in samples], dtype=torch.long)
+    return inputs, targets, target_lengths
+
+
+@torch.no_grad()
+def accuracy(net: CTCCaptchasNet, samples: List[Tuple[np.ndarray, str]], batch_size: int) -> float:
+    net.eval()
+    correct = 0
+    for i in range(0, len(samples), batch_size):
+        batch = samples[i : i + batch_size]
+        inputs, _, _ = make_batch(net, batch)
+        predictions = net.decode(net(inputs))
+        correct += sum(text == label for (text, _), (_, label) in zip(predictions, batch))
+    return correct / max(len(samples), 1)
+
+
+def train(args):
+    net = CTCCaptchasNet(args.vocab or captcha_type2vocab[args.net_type])
+    samples = load_dataset(args.data)
+    random.Random(0).shuffle(samples)
+    n_val = int(len(samples) * args.val_fraction)
+    val_samples, train_samples = samples[:n_val], samples[n_val:]
+
+    optimizer = torch.optim.Adam(net.model.parameters(), lr=args.lr)
+    criterion = torch.nn.CTCLoss(blank=0, zero_infinity=True)
+    best_accuracy = -1.0
+    for epoch in range(args.epochs):
+        net.train()
+        random.shuffle(train_samples)
+        losses = []
+        for i in range(0, len(train_samples), args.batch_size):
+            inputs, targets, target_lengths = make_batch(net, train_samples[i : i + args.batch_size])
+            log_probs = net(inputs)
+            input_lengths = torch.full((inputs.shape[0],), log_probs.shape[0], dtype=torch.long)
+            loss = criterion(log_probs, targets, input_lengths, target_lengths)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+
+        val_accuracy = accuracy(net, val_samples, args.batch_size)
+        print(f"epoch {epoch + 1}: loss {np.mean(losses):.4f}, val accuracy {val_accuracy:.4f}")
+        if val_accuracy > best_accuracy:
+            best_accuracy = val_accuracy
+            torch.save({"model_state_dict": net.model.state_dict()}, args.out)
+    print(f"Saved weights with val accuracy {best_accuracy:.4f} to {args.out}")
+
+
+def evaluate(args):
+    processor = load_processor(args.net_type, args.fast_weights, args.threshold)
+    samples = load_dataset(args.data)
+
+    detector_correct, detector_time = 0, 0.0
+    cascade_correct, cascade_time, fast_hits, fast_correct = 0, 0.0, 0, 0
+    for image, label in samples:
+        started = perf_counter()
+        result = processor.process_full(image)
+        detector_time += perf_counter() - started
+        detector_correct += result.text == label
+
+        started = perf_counter()
+        result = processor.process_fast(image)
+        if result.confidence >= processor.fast_threshold:
+            fast_hits += 1
+            fast_correct += result.text == label
+        else:
+            result = processor.process_full(image)
+        cascade_time += perf_counter() - started
+        cascade_correct += result.text == label
+
+    n = max(len(samples), 1)
+    print(f"samples: {len(samples)}, fast path threshold: {args.threshold}")
+    print(f"detector only: accuracy {detector_correct / n:.4f}, mean latency {detector_time / n * 1000:.1f} ms")
+    print(f"cascade: accuracy {cascade_correct / n:.4f}, mean latency {cascade_time / n * 1000:.1f} ms")
+    print(f"fast path: hit rate {fast_hits / n:.4f}, accuracy on hits {fast_correct / max(fast_hits, 1):.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train and evaluate fast path recognizer")
+    parser.add_argument("mode", choices=["train", "eval"])
+    parser.add_argument("net_type", choices=[CaptchaType.fns.name, CaptchaType.alcolicenziat.name])
+    parser.add_argument("--data", required=True, help="directory with labeled captcha images")
+    # train
+    parser.add_argument("--vocab", help="vocabulary pickle. Detector vocabulary of the captcha type by default")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--out", help="where to save weights")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--val-fraction", type=float, default=0.1)
+    # eval
+    parser.add_argument("--fast-weights", help="weights of the fast path recognizer")
+    parser.add_argument("--threshold", type=float, default=0.9, help="min confidence to accept fast path result")
+    args = parser.parse_args()
+
+    if args.mode == "train":
+        if not args.out:
+            parser.error("--out is required for training")
+        train(args)
+    else:
+        if not args.fast_weights:
+            parser.error("--fast-weights is required for evaluation")
+        evaluate(args)
@@ -5,23 +5,53 @@ from pathlib import Path
 import sentry_sdk
 from sentry_sdk.integrations.logging import LoggingIntegration
 
+from capts.businesslogic.stats import SolveTimeStats
 from capts.businesslogic.task import TaskTracker
-from capts.businesslogic.utils import Logger
+from capts.sharding import ShardedRedis
 from capts.storage import RedisStorage
+from capts.utils import Logger
 
 api_logger = Logger.from_config("api_logger", Path(__file__).parent / "loggers.conf")
 nn_logger = Logger.from_config("nn_logger", Path(__file__).parent / "loggers.conf")
+sweeper_logger = Logger.from_config("sweeper_logger", Path(__file__).parent / "loggers.conf")
 dev_logger = Logger.from_config("development_logger", Path(__file__).parent / "loggers.conf")
 
 REDIS_URL = os.environ.get("REDIS_URL")
+# comma separated redis nodes for tasks and images. REDIS_URL if not set
+REDIS_URLS = os.environ.get("REDIS_URLS", REDIS_URL or "").split(",")
+# nodes before the last change of REDIS_URLS. Tasks and images are looked up there until they expire
+REDIS_PREVIOUS_URLS = [url for url in os.environ.get("REDIS_PREVIOUS_URLS", "").split(",") if url]
 RABBIT_URL = os.environ.get("RABBIT_URL")
-RABBIT_PORT = int(os.environ.get("RABBIT_PORT"))
+RABBIT_PORT = int(os.environ.get("RABBIT_PORT", 5672))
 RABBIT_LOGIN = os.environ.get("RABBIT_LOGIN")
 RABBIT_PASSWORD = os.environ.get("RABBIT_PASSWORD")
 SENTRY_LINK = os.environ.get("SENTRY_LINK")
 
-task_tracker = TaskTracker.from_url(REDIS_URL)
-redis_storage = RedisStorage(dsn=REDIS_URL)
+# seconds to keep tasks and not processed images in redis
+TASK_TTL = int(os.environ.get("TASK_TTL", 24 * 60 * 60))
+IMAGE_TTL = int(os.environ.get("IMAGE_TTL", 60 * 60))
+
+# images not larger than this number of bytes are sent inside queue messages instead of redis. 0 disables
+INLINE_IMAGE_MAX_BYTES = int(os.environ.get("INLINE_IMAGE_MAX_BYTES", 0))
+
+# on-demand profiling of nn workers
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/capts-profiles")
+PROFILE_REQUESTS = int(os.environ.get("PROFILE_REQUESTS", 20))
+
+# admission control. Captchas are rejected when predicted waiting time in the queue exceeds the budget (seconds)
+ADMISSION_WAIT_BUDGET = float(os.environ.get("ADMISSION_WAIT_BUDGET", 30))
+ADMISSION_CACHE_TTL = float(os.environ.get("ADMISSION_CACHE_TTL", 1))
+ADMISSION_DEFAULT_SOLVE_TIME = float(os.environ.get("ADMISSION_DEFAULT_SOLVE_TIME", 1))
+# per-client token bucket. Requests per second, 0 disables the limit
+CLIENT_RATE_LIMIT = float(os.environ.get("CLIENT_RATE_LIMIT", 0))
+CLIENT_BURST = int(os.environ.get("CLIENT_BURST", 10))
+# header to identify clients by. Client host is used if not set
+CLIENT_ID_HEADER = os.environ.get("CLIENT_ID_HEADER")
+
+redis_shards = ShardedRedis.from_urls(REDIS_URLS, REDIS_PREVIOUS_URLS, health_check_interval=30, socket_keepalive=True)
+task_tracker = TaskTracker(redis_shards, ttl=TASK_TTL)
+redis_storage = RedisStorage(shards=redis_shards, ttl=IMAGE_TTL)
+solve_stats = SolveTimeStats(redis_shards, ttl=TASK_TTL)
 
 
 class CaptchaType(str, Enum):
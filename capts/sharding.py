@@ -0,0 +1,62 @@
+import bisect
+import hashlib
+from typing import Dict, List, Optional, Sequence
+
+from redis import Redis
+
+
+def hash_key(key: str) -> int:
+    # builtin hash is randomized between processes
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring. Adding or removing a node moves only the keys of that node"""
+
+    def __init__(self, nodes: Sequence[str], replicas: int = 128):
+        if not nodes:
+            raise ValueError("Hash ring needs at least one node")
+        points = sorted((hash_key(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardedRedis:
+    """Set of redis nodes. Every key is stored on the node chosen by the consistent hash ring.
+
+    All keys of one task (task state, image chunks, registry entry) are routed by the task id, so operations
+    on a task never span several nodes. While nodes are being added or removed, pass the old set of nodes as
+    `previous`: reads fall back to the node which owned the key before, writes go to the new owner and the old
+    copies expire by their TTL.
+    """
+
+    def __init__(self, nodes: Dict[str, Redis], previous: Optional[Dict[str, Redis]] = None):
+        self._nodes = nodes
+        self._ring = HashRing(list(nodes))
+        self._previous_nodes = previous or {}
+        self._previous_ring = HashRing(list(self._previous_nodes)) if self._previous_nodes else None
+
+    @classmethod
+    def from_urls(cls, urls: Sequence[str], previous_urls: Sequence[str] = (), **kwargs):
+        clients = {url: Redis.from_url(url, **kwargs) for url in {*urls, *previous_urls}}
+        return cls({url: clients[url] for url in urls}, {url: clients[url] for url in previous_urls})
+
+    @property
+    def nodes(self) -> List[Redis]:
+        """All nodes including the previous ones"""
+        return list({id(node): node for node in [*self._nodes.values(), *self._previous_nodes.values()]}.values())
+
+    def for_key(self, key: str) -> Redis:
+        return self._nodes[self._ring.get_node(key)]
+
+    def candidates(self, key: str) -> List[Redis]:
+        """Nodes which may store the key. The current owner goes first"""
+        owner = self.for_key(key)
+        if self._previous_ring is None:
+            return [owner]
+        previous_owner = self._previous_nodes[self._previous_ring.get_node(key)]
+        return [owner] if previous_owner is owner else [owner, previous_owner]
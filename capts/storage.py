@@ -7,6 +7,8 @@ from typing import Any, List, MutableMapping, Optional, Tuple, Union
 
 from redis import Redis
 
+from capts.sharding import ShardedRedis
+
 
 class NotExisted(Exception):
     pass
@@ -117,16 +119,32 @@ class Storage(MutableMapping, ABC):
 
 
 class RedisStorage(Storage):
-    def __init__(self, dsn: Optional[str] = None, namespace: str = "namespace", chunksize: int = 2 ** 28, **kwargs):
-        params = {"health_check_interval": 30, "socket_keepalive": True}
-        kwargs.update(params)
+    """Хранилище в redis. Если передан `shards`, каждый ключ хранится на узле, выбранном по ключу.
+    Реестр ключей ведется на каждом узле отдельно.
+    """
 
-        if dsn:
-            self.redis = Redis.from_url(dsn, **kwargs)
-        else:
-            self.redis = Redis(**kwargs)
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        namespace: str = "namespace",
+        chunksize: int = 2 ** 28,
+        ttl: Optional[int] = None,
+        shards: Optional[ShardedRedis] = None,
+        **kwargs,
+    ):
+        if shards is None:
+            params = {"health_check_interval": 30, "socket_keepalive": True}
+            kwargs.update(params)
+
+            if dsn:
+                redis = Redis.from_url(dsn, **kwargs)
+            else:
+                redis = Redis(**kwargs)
+            shards = ShardedRedis({dsn or "default": redis})
+        self.shards = shards
 
         self.chunksize = chunksize
+        self.ttl = ttl
         self.registry_name = "RedisStorageRegistry"
         self.chunks_suffix = "chunks"
         super().__init__(namespace)
@@ -145,33 +163,45 @@ class RedisStorage(Storage):
         registry = self._get_registry_name()
         name = self._get_chunksname(key)
 
-        with self.redis.pipeline() as pipe:
+        with self.shards.for_key(key).pipeline() as pipe:
             pipe.delete(name)
             for chunk in chunks_tuple:
                 pipe.rpush(name, chunk)
             pipe.hset(registry, key, 1)  # dummy value 1. Only for key existing
+            if self.ttl:
+                # registry entries can not expire by themselves. Sweeper removes entries of expired chunks
+                pipe.expire(name, self.ttl)
+                pipe.expire(registry, self.ttl)
             pipe.execute()
 
-    def _read_by_chunks(self, key: str):
+    def _read_by_chunks(self, redis: Redis, key: str):
         name = self._get_chunksname(key)
-        chunks_tuple = self.redis.lrange(name, 0, -1)
+        chunks_tuple = redis.lrange(name, 0, -1)
         return join_chunks(chunks_tuple)
 
+    def _find_node(self, key: str) -> Optional[Redis]:
+        for redis in self.shards.candidates(key):
+            if redis.hexists(self._get_registry_name(), key):
+                return redis
+        return None
+
     def __delitem__(self, key: str):
         registry = self._get_registry_name()
         name = self._get_chunksname(key)
 
-        with self.redis.pipeline() as pipe:
-            pipe.delete(name)
-            pipe.hdel(registry, key)
-            pipe.execute()
+        for redis in self.shards.candidates(key):
+            with redis.pipeline() as pipe:
+                pipe.delete(name)
+                pipe.hdel(registry, key)
+                pipe.execute()
 
     def _read_bytes(self, key: str) -> bytes:
-        if not self.exists(key):
+        redis = self._find_node(key)
+        if redis is None:
             raise KeyError(
                 f"There is no key '{key}' in {self.__class__.__name__} with namespace '{str(self.namespace)}'"
             )
-        return self._read_by_chunks(key)
+        return self._read_by_chunks(redis, key)
 
     def _write_bytes(self, obj: bytes, key: Optional[str] = None) -> str:
         key = key or self._generate_key()
@@ -179,11 +209,12 @@ class RedisStorage(Storage):
         return key
 
     def exists(self, key: str) -> bool:
-        return self.redis.hexists(self._get_registry_name(), key)
+        return self._find_node(key) is not None
 
     def __len__(self):
         return len(list(self.__iter__()))
 
     def __iter__(self):
-        keys = sorted([key.decode("utf-8") for key in self.redis.hkeys(self._get_registry_name())])
+        registry = self._get_registry_name()
+        keys = sorted({key.decode("utf-8") for redis in self.shards.nodes for key in redis.hkeys(registry)})
         return iter(keys)